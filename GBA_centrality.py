@@ -20,99 +20,292 @@ import os
 import sys
 import logging
 import pathlib
+import hashlib
+import concurrent.futures
 
 import argparse
 
 import numpy
-import networkx
+import scipy.sparse
 
 import data_parser
 
 # set up logger, using inherited config, in case we get called as a module
 logger = logging.getLogger(__name__)
 
+# number of source nodes whose walks are counted together in count_walks(),
+# memory usage is len(interactome.nodes()) * BLOCK_SIZE floats per thread
+BLOCK_SIZE = 256
 
-def calculate_scores(interactome, adjacency_matrices, causal_genes, alpha) -> dict:
+# format of the contributions cache files written by get_contributions(), part of
+# their cache key: bump it whenever the calculation or the stored dtype changes
+CACHE_VERSION = b'contributions v1 float32'
+
+
+def calculate_scores(interactome, contributions, alpha):
     '''
     Calculate scores for every gene in the interactome based on the proximity to known causal genes.
 
     arguments:
     - interactome: type=networkx.Graph
-    - adjacency_matrices: list of numpy arrays as returned by get_adjacency_matrices()
-    - causal_genes: dict of causal genes with key=ENSG, value=1
+    - contributions: 2D numpy array as returned by calculate_contributions()
     - alpha: attenuation coefficient (parameter set by user)
 
     returns:
-    - scores: dict with key=ENSG, value=score
+    - nodes: list of ENSGs, ordered as in interactome.nodes()
+    - scores: 1D numpy array, scores[i] is the score of nodes[i]
     '''
-    # 1D numpy array for genes in the interactome: 1 if causal gene, 0 otherwise
-    # size=len(nodes in interactome), ordered as in interactome.nodes()
-    causal_genes_vec = numpy.zeros(len(interactome.nodes()), dtype=numpy.uint8)
-    ni = 0
-    for n in interactome.nodes():
-        if n in causal_genes:
-            causal_genes_vec[ni] = 1
-        ni += 1
+    # weights[d] == alpha**d
+    weights = alpha ** numpy.arange(contributions.shape[0], dtype=numpy.float32)
+    scores = weights @ contributions
 
-    # calculate scores
-    scores_vec = numpy.zeros(len(causal_genes_vec))
-    for d in range(0, len(adjacency_matrices)):
-        A = adjacency_matrices[d]
-        scores_vec += alpha ** d * A.dot(causal_genes_vec)
+    return list(interactome.nodes()), scores
 
-    scores = dict(zip(interactome.nodes(), scores_vec))  # map scores to genes
 
-    return scores
+def get_adjacency_matrix(interactome, node2idx):
+    '''
+    Build the (symmetric) adjacency matrix of the interactome, directly from its edges
+    rather than with networkx.to_scipy_sparse_array() which is slower.
 
+    arguments:
+    - interactome: type=networkx.Graph
+    - node2idx: dict with key=node, value=index of node in interactome.nodes()
 
-def get_adjacency_matrices(interactome, d_max):
+    returns:
+    - A: adjacency matrix, type=scipy.sparse.csr_array of numpy.float32,
+        rows and columns are ordered as in interactome.nodes()
     '''
-    Calculates powers of adjacency matrix up to power d_max (using non-normalized matrices).
-    Then zeroes the diagonal and normalizes each matrix (row-wise).
+    num_nodes = len(interactome.nodes())
+
+    # edges[k] == indexes of both ends of the k-th edge
+    edges = numpy.fromiter((node2idx[n] for e in interactome.edges() for n in e),
+                           dtype=numpy.int32, count=2 * len(interactome.edges())).reshape(-1, 2)
+    # each edge appears in both directions, except self-loops
+    loops = edges[:, 0] == edges[:, 1]
+    rows = numpy.concatenate((edges[:, 0], edges[~loops, 1]))
+    cols = numpy.concatenate((edges[:, 1], edges[~loops, 0]))
+    # float32 rather than an integer type, see count_walks()
+    data = numpy.ones(len(rows), dtype=numpy.float32)
+
+    return scipy.sparse.csr_array((data, (rows, cols)), shape=(num_nodes, num_nodes))
+
+
+def calculate_contributions(interactome, causal_genes, d_max, threads=1, device='cpu', contributions=None):
+    '''
+    Calculate the contributions of causal genes at each distance d (0 <= d <= d_max) to the
+    score of every gene in the interactome. These don't depend on alpha.
+
+    For each node, walks of length d starting at this node and never coming back to it
+    are counted; the contribution at distance d is the fraction of these walks that end
+    on a causal gene.
+    Walks are counted by repeated sparse matrix products with the adjacency matrix, for
+    blocks of BLOCK_SIZE source nodes at a time (see count_walks()): powers of the adjacency
+    matrix are never built.
 
     arguments:
     - interactome: type=networkx.Graph
+    - causal_genes: dict of causal genes with key=ENSG, value=1
     - d_max: max distance from a causal gene for it to contribute to a node's score (parameter set by user)
+    - threads: number of blocks of source nodes processed in parallel (with device='cpu')
+    - device: 'cpu', or 'cuda' to count walks on a GPU (requires CuPy)
+    - contributions: optional float32 array of shape (d_max+1, len(interactome.nodes())) to fill
+      (eg a numpy.memmap), a new array is allocated if None
 
     returns:
-    - adjacency_matrices: list of numpy arrays,
-        array at index i (starting at i==0) is the processed A**i,
-        rows and columns are ordered as in interactome.nodes()
+    - contributions: 2D numpy array, contributions[d, i] is the contribution at distance d
+        to the score of node i, nodes are ordered as in interactome.nodes()
     '''
-    # list of processed matrices, should all be of the same type (eg numpy.float32)
-    adjacency_matrices = []
-
-    A = networkx.to_scipy_sparse_array(interactome, dtype=numpy.uint64, format='csc')
+    num_nodes = len(interactome.nodes())
+    node2idx = {n: i for i, n in enumerate(interactome.nodes())}
 
-    # temporary variable for A**power
-    res = numpy.identity(A.shape[0], dtype=numpy.uint64)
-    adjacency_matrices.append(res.astype(numpy.float32))
+    # 1D numpy array for genes in the interactome: 1 if causal gene, 0 otherwise
+    # size=len(nodes in interactome), ordered as in interactome.nodes()
+    causal_genes_vec = numpy.zeros(num_nodes, dtype=numpy.float32)
+    causal_genes_vec[[node2idx[n] for n in causal_genes if n in node2idx]] = 1
+
+    # everything is float32: walk counts don't need more precision and this halves memory traffic
+    if contributions is None:
+        contributions = numpy.empty((d_max + 1, num_nodes), dtype=numpy.float32)
+
+    # d==0: every node only reaches itself
+    contributions[0] = causal_genes_vec
+    if d_max == 0:
+        return contributions
+
+    A = get_adjacency_matrix(interactome, node2idx)
+
+    # d==1: walks of length 1 are the edges, their number is the degree (ignoring self-loops)
+    self_loops = A.diagonal()
+    degrees = A.sum(axis=1) - self_loops
+    degrees[degrees == 0] = 1
+    contributions[1] = (A @ causal_genes_vec - self_loops * causal_genes_vec) / degrees
+    if d_max == 1:
+        return contributions
+
+    # 2 columns: causal genes and all-ones, so that one pass over the walk counts
+    # yields both the causal contributions and the row sums used for normalization
+    RHS = numpy.column_stack([causal_genes_vec, numpy.ones(num_nodes, dtype=numpy.float32)])
+    # columns: number of causal neighbors and degree, used for the last distance d_max
+    A_RHS = A @ RHS
+
+    # d>=2: count walks for blocks of sources
+    if device == 'cuda':
+        count_walks_cuda(A, RHS, A_RHS, d_max, contributions)
+        return contributions
+
+    # on CPU: in parallel threads (scipy and numpy release the GIL during the matrix products)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = [executor.submit(count_walks, A, RHS, A_RHS, start, min(start + BLOCK_SIZE, num_nodes),
+                                   d_max, contributions)
+                   for start in range(0, num_nodes, BLOCK_SIZE)]
+        # raise any exception from the threads
+        for future in futures:
+            future.result()
+
+    return contributions
+
+
+def count_walks(A, RHS, A_RHS, start, stop, d_max, contributions, xp=numpy):
+    '''
+    Count walks of length 2 to d_max (that never come back to their source) for the block
+    of source nodes start to stop-1, and fill the corresponding columns of contributions.
 
-    for power in range(1, d_max + 1):
-        logger.debug(f"Calculating A**{power}")
-        # @ - matrix multiplication, result of numpy @ CSC is numpy
-        # res in CSR and A in CSC format should be fast, but it is slow,
-        # also res and A in numpy format is very slow;
-        # res in numpy format and A in CSC format is the fastest
-        res = res @ A
+    Walks of length d_max are never built: since A is symmetric, their products with RHS
+    are obtained from the walks of length d_max-1 and A @ RHS.
 
-        # zero the diagonal
-        numpy.fill_diagonal(res, val=0)
+    Walk counts are stored as float32, like A and RHS, so the products never change dtype.
+    They grow roughly like degree**d and would overflow integer types (eg int32 is
+    exceeded at d==4 for nodes of degree ~250), while only their ratios are used.
 
-        # row-wise normalization
-        res_norm = res.astype(numpy.float32)
-        row_sum = res_norm.sum(axis=1)  # row-wise axis=1, column-wise axis=0
+    arguments:
+    - A: adjacency matrix, type=scipy.sparse.csr_array
+    - RHS: 2D numpy array, columns are the causal genes vector and all-ones
+    - A_RHS: A @ RHS
+    - start, stop: indexes of the first and last+1 source nodes
+    - d_max, contributions: see calculate_contributions()
+    - xp: array module of A, RHS and contributions: numpy, or cupy for arrays on a GPU
+    '''
+    sources = xp.arange(start, stop)
+    logger.debug("Calculating contributions to nodes %i to %i", start, stop - 1)
+
+    # walks[j, b] == number of walks from sources[b] to node j (that never come back to sources[b]),
+    # starting with walks of length 1: A is symmetric so these are rows start to stop-1 of A
+    A_sources = A[start:stop]
+    walks = A_sources.T.toarray(order='C')
+    # flat indexes (in C order) of walks[sources[b], b], ie walks that are back at their source
+    self_walks = sources * len(sources) + xp.arange(len(sources))
+    walks.put(self_walks, 0)
+
+    # buffer reused at each distance for walks.T @ RHS
+    out = xp.empty((len(sources), 2), dtype=xp.float32)
+    row_sum = out[:, 1]
+
+    for d in range(2, d_max):
+        # A is symmetric: extend each walk by one edge
+        walks = A @ walks
+        # zero the walks that come back to their source
+        walks.put(self_walks, 0)
+
+        xp.matmul(walks.T, RHS, out=out)
+        # row-wise normalization, sources without walks have no causal contributions
         row_sum[row_sum == 0] = 1
-        res_norm_T = res_norm.T
-        res_norm_T /= row_sum
+        xp.divide(out[:, 0], row_sum, out=contributions[d, start:stop])
+
+    # d==d_max: (A @ walks).T @ RHS == walks.T @ A_RHS, minus the walks that come back to
+    # their source: back[b] == (A @ walks)[sources[b], b] == A[sources[b]] @ walks[:, b]
+    xp.matmul(walks.T, A_RHS, out=out)
+    A_sources = A_sources.tocoo()
+    back = xp.bincount(A_sources.row, weights=A_sources.data * walks[A_sources.col, A_sources.row],
+                       minlength=len(sources)).astype(xp.float32)
+    row_sum -= back
+    row_sum[row_sum == 0] = 1
+    xp.divide(out[:, 0] - RHS[start:stop, 0] * back, row_sum, out=contributions[d_max, start:stop])
+
+
+def count_walks_cuda(A, RHS, A_RHS, d_max, contributions):
+    '''
+    Same as the d>=2 part of calculate_contributions(), on a CUDA GPU: A and RHS are copied
+    to the GPU once, blocks of source nodes are processed there one after the other, and
+    contributions[2:] are copied back at the end.
+    Requires CuPy (https://cupy.dev/).
+
+    arguments:
+    - A, RHS, A_RHS: see count_walks()
+    - d_max, contributions: see calculate_contributions()
+    '''
+    # optional dependency, only needed with device='cuda'
+    import cupy
+    import cupyx.scipy.sparse
+
+    num_nodes = A.shape[0]
+    A_gpu = cupyx.scipy.sparse.csr_matrix((cupy.asarray(A.data), cupy.asarray(A.indices),
+                                           cupy.asarray(A.indptr)), shape=A.shape)
+    RHS_gpu = cupy.asarray(RHS)
+    A_RHS_gpu = cupy.asarray(A_RHS)
+    contributions_gpu = cupy.empty((d_max + 1, num_nodes), dtype=cupy.float32)
+
+    for start in range(0, num_nodes, BLOCK_SIZE):
+        count_walks(A_gpu, RHS_gpu, A_RHS_gpu, start, min(start + BLOCK_SIZE, num_nodes), d_max,
+                    contributions_gpu, cupy)
 
-        adjacency_matrices.append(res_norm)
+    contributions[2:] = contributions_gpu[2:].get()
 
-    logger.debug("Done building %i matrices", len(adjacency_matrices))
-    return adjacency_matrices
 
+def get_contributions(interactome, causal_genes, d_max, threads=1, device='cpu', cache_dir=None):
+    '''
+    Return calculate_contributions(interactome, causal_genes, d_max, threads, device), reusing the result
+    of a previous run with the same interactome, causal genes and d_max if it was
+    saved in cache_dir. This makes runs that only change alpha almost instantaneous.
+
+    arguments:
+    - interactome, causal_genes, d_max, threads, device: see calculate_contributions()
+    - cache_dir: directory (created if needed) where contributions are saved, type=pathlib.Path,
+      None to disable the cache
 
-def main(interactome_file, causal_genes_file, uniprot_file, patho, alpha, d_max):
+    returns:
+    - contributions: 2D numpy array as returned by calculate_contributions()
+    '''
+    if cache_dir is None:
+        return calculate_contributions(interactome, causal_genes, d_max, threads, device)
+
+    # cache key: the cache format, the interactome (including the order of its nodes),
+    # the causal genes and d_max
+    sha = hashlib.sha256()
+    sha.update(CACHE_VERSION + b'\n')
+    for n in interactome.nodes():
+        sha.update(n.encode() + b'\n')
+    for (n1, n2) in interactome.edges():
+        sha.update(n1.encode() + b'\t' + n2.encode() + b'\n')
+    for n in sorted(causal_genes):
+        sha.update(b'causal\t' + n.encode() + b'\n')
+    cache_file = cache_dir / f"contributions_dmax{d_max}_{sha.hexdigest()[:16]}.npy"
+
+    if cache_file.exists():
+        logger.info("Loading contributions from cache file %s", cache_file)
+        return numpy.load(cache_file, mmap_mode='r')
+
+    # calculate contributions directly in a memory-mapped .npy file, written under a
+    # temporary name so that an interrupted run never leaves an incomplete cache file;
+    # the name is specific to this process so that concurrent runs sharing cache_dir
+    # (eg a sweep over alpha) never write to the same file
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+    contributions = numpy.lib.format.open_memmap(tmp_file, mode='w+', dtype=numpy.float32,
+                                                 shape=(d_max + 1, len(interactome.nodes())))
+    try:
+        calculate_contributions(interactome, causal_genes, d_max, threads, device, contributions)
+        contributions.flush()
+        os.replace(tmp_file, cache_file)
+    except BaseException:
+        # don't leave a partial tmp_file behind, eg after an error or Ctrl-C
+        tmp_file.unlink(missing_ok=True)
+        raise
+    logger.info("Saved contributions to cache file %s", cache_file)
+    return contributions
+
+
+def main(interactome_file, causal_genes_file, uniprot_file, patho, alpha, d_max,
+         threads, device, cache_dir):
 
     logger.info("Parsing interactome")
     interactome = data_parser.parse_interactome(interactome_file)
@@ -123,14 +316,14 @@ def main(interactome_file, causal_genes_file, uniprot_file, patho, alpha, d_max)
     logger.info("Parsing causal genes")
     causal_genes = data_parser.parse_causal_genes(causal_genes_file, gene2ENSG, interactome, patho)
 
-    logger.info("Calculating powers of adjacency matrix")
-    adjacency_matrices = get_adjacency_matrices(interactome, d_max)
+    logger.info("Calculating contributions of causal genes")
+    contributions = get_contributions(interactome, causal_genes, d_max, threads, device, cache_dir)
 
     logger.info("Calculating scores")
-    scores = calculate_scores(interactome, adjacency_matrices, causal_genes, alpha)
+    nodes, scores = calculate_scores(interactome, contributions, alpha)
 
     logger.info("Printing scores")
-    data_parser.scores_to_TSV(scores, ENSG2gene)
+    data_parser.scores_to_TSV(nodes, scores, ENSG2gene)
 
     logger.info("Done!")
 
@@ -178,8 +371,24 @@ if __name__ == "__main__":
                         help='max distance from a causal gene for it to contribute to a node\' score',
                         default=5,
                         type=int)
+    parser.add_argument('--threads',
+                        help='number of threads used to calculate contributions of causal genes, '
+                             'defaults to the number of CPUs',
+                        default=os.cpu_count(),
+                        type=int)
+    parser.add_argument('--device',
+                        help='where walks are counted: cpu, or cuda for a GPU (requires CuPy)',
+                        default='cpu',
+                        choices=['cpu', 'cuda'])
+    parser.add_argument('--cache_dir',
+                        help='directory where contributions of causal genes are saved and reused by '
+                             'later runs with the same interactome, causal genes and d_max '
+                             '(eg when only alpha changes)',
+                        type=pathlib.Path)
 
     args = parser.parse_args()
+    if args.threads < 1:
+        parser.error(f"argument --threads: must be at least 1, got {args.threads}")
 
     try:
         main(interactome_file=args.interactome_file,
@@ -187,7 +396,10 @@ if __name__ == "__main__":
              patho=args.patho,
              uniprot_file=args.uniprot_file,
              alpha=args.alpha,
-             d_max=args.d_max)
+             d_max=args.d_max,
+             threads=args.threads,
+             device=args.device,
+             cache_dir=args.cache_dir)
 
     except Exception as e:
         # details on the issue should be in the exception name, print it to stderr and die
@@ -174,21 +174,23 @@ def parse_causal_genes(causal_genes_file, gene2ENSG, interactome, patho) -> dict
     return causal_genes
 
 
-def scores_to_TSV(scores, ENSG2gene):
+def scores_to_TSV(nodes, scores, ENSG2gene):
     '''
     Print scores to stdout in TSV format, 3 columns: ENSG gene_name score
 
     arguments:
-    - scores: dict with key=ENSG, value=score
+    - nodes: list of ENSGs
+    - scores: 1D numpy array, scores[i] is the score of nodes[i]
     - ENSG2gene: dict of all known gene names, key=ENSG, value=gene_name
     '''
 
     # header
-    print("ENSG\tGENE\tSCORE")
+    lines = ["ENSG\tGENE\tSCORE"]
 
-    for (ENSG, score) in sorted(scores.items()):
+    for i in sorted(range(len(nodes)), key=nodes.__getitem__):
         # GENE defaults to "" if we don't know the gene name of ENSG
-        gene = ""
-        if ENSG in ENSG2gene:
-            gene = ENSG2gene[ENSG]
-        print(ENSG + "\t" + gene + "\t" + str(score))
+        ENSG = nodes[i]
+        gene = ENSG2gene.get(ENSG, "")
+        lines.append(ENSG + "\t" + gene + "\t" + str(scores[i]))
+
+    print("\n".join(lines))